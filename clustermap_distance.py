@@ -279,10 +279,10 @@ def NGC(spots):
             res_dis[indi] = res_dis[indi][X_data[i, 2] - X_data[indi, 2] <= smaller_radius]
 
     res_ngc = np.zeros((spot_number, len(gene_list)))
+    genes = spots['gene'].to_numpy() - np.min(gene_list)
     for i in trange(spot_number):
         neighbors_i = res_neighbors[i]
-        genes_neighbors_i = spots.loc[neighbors_i, :].groupby('gene').size()
-        res_ngc[i, genes_neighbors_i.index.to_numpy() - np.min(gene_list)] = np.array(genes_neighbors_i)
+        res_ngc[i] = np.bincount(genes[neighbors_i], minlength=len(gene_list))
         # res_ngc[i] /= len(neighbors_i)
     return res_ngc
 
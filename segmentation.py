@@ -1,5 +1,4 @@
 import os
-import pickle
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -7,6 +6,7 @@ import numpy as np
 from sklearn.cluster import DBSCAN
 
 import stumap as umap
+from stumap.MSNGC.feature_extractor import load_st
 
 
 def convert(st_data):
@@ -21,11 +21,7 @@ def convert(st_data):
 
 st_file = r'stumap/MSNGC/h_st.pkl'
 
-with open(os.path.join(st_file), 'rb') as f:
-    st_data = pickle.loads(f.read())
-    pass
-
-st_data = convert(st_data)
+st_data = convert(load_st(os.path.join(st_file)))
 reducer = umap.UMAP(metric='euclidean',
                     n_neighbors=100)
 embedding = reducer.fit_transform(st_data)
@@ -1,11 +1,13 @@
 import os
 import pickle
-from itertools import product
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 import numba
 import numpy as np
 from scipy import sparse
 from scipy.ndimage import gaussian_filter
+from scipy.spatial import cKDTree
 from scipy.sparse import hstack
 from skimage.filters import threshold_otsu
 from skimage.morphology import square, erosion, reconstruction
@@ -13,18 +15,101 @@ from sklearn.neighbors import NearestNeighbors, LocalOutlierFactor
 from tqdm import tqdm
 from tqdm import trange
 
-from data_preprocess.preprocess import dataloader_STARmap_MousePlacenta, dataloader_STARmap_human_cardiac_organoid
+# spots per NGC radius query, override with the STUMAP_NGC_TILE_SIZE environment variable
+NGC_TILE_SIZE = int(os.environ.get('STUMAP_NGC_TILE_SIZE', 65536))
 
 
-def binarize_dapi(dapi, fast_preprocess, gauss_blur, sigma):
+def otsu_stack(vol, nbins=256):
+    """
+    Binarize every z slice of a y,x,z volume with its own Otsu threshold
+
+    Matches skimage.filters.threshold_otsu per slice: float slices use nbins equal-width bins,
+    integer slices get one bin per value between their min and max and nbins is ignored.
+
+    params : - vol (ndarray) = y,x,z image stack
+             - nbins (int) = number of histogram bins per float slice
+
+    returns : - binary (ndarray) = y,x,z boolean stack, constant slices are all True
+    """
+    return _otsu_stack(vol, nbins, np.issubdtype(vol.dtype, np.integer))
+
+
+@numba.njit(parallel=True)
+def _otsu_stack(vol, nbins, integer):
+    binary = np.empty(vol.shape, dtype=np.bool_)
+    for t in numba.prange(vol.shape[2]):
+        plane = vol[:, :, t]
+        vmin = float(plane.min())
+        vmax = float(plane.max())
+        thresh = vmin
+        if vmax > vmin:
+            # histogram over [vmin, vmax], thresholds at the bin centers as in skimage
+            if integer:
+                n = int(vmax - vmin) + 1
+                scale = 1.0
+                offset = 0.0
+            else:
+                n = nbins
+                scale = nbins / (vmax - vmin)
+                offset = 0.5
+            hist = np.zeros(n, dtype=np.float64)
+            for i in range(plane.shape[0]):
+                for j in range(plane.shape[1]):
+                    k = int((plane[i, j] - vmin) * scale)
+                    if k >= n:
+                        k = n - 1
+                    hist[k] += 1
+            centers = vmin + (np.arange(n) + offset) / scale
+            total = hist.sum()
+            total_sum = (hist * centers).sum()
+            weight1 = 0.0
+            sum1 = 0.0
+            best = -1.0
+            for k in range(n - 1):
+                weight1 += hist[k]
+                sum1 += hist[k] * centers[k]
+                weight2 = total - weight1
+                if weight1 == 0 or weight2 == 0:
+                    continue
+                variance12 = weight1 * weight2 * (sum1 / weight1 - (total_sum - sum1) / weight2) ** 2
+                if variance12 > best:
+                    best = variance12
+                    thresh = centers[k]
+        for i in range(plane.shape[0]):
+            for j in range(plane.shape[1]):
+                binary[i, j, t] = plane[i, j] >= thresh
+    return binary
+
+
+def _reconstruct_slice(dapi_one_page, reconstruction_method='opencv'):
+    if reconstruction_method == 'opencv':
+        # OpenCV is only needed for this method, keep it optional for the rest of the module
+        import cv2
+
+        # opening (erode + dilate) with a 5x5 square approximates the grayscale reconstruction
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (5, 5))
+        return cv2.morphologyEx(np.ascontiguousarray(dapi_one_page), cv2.MORPH_OPEN, kernel)
+    elif reconstruction_method == 'scikit':
+        dapi_marker = erosion(dapi_one_page, square(5))
+        return reconstruction(dapi_marker, dapi_one_page)
+    else:
+        raise ValueError("reconstruction_method must be 'opencv' or 'scikit'")
+
+
+def binarize_dapi(dapi, fast_preprocess, gauss_blur, sigma, n_jobs=1, reconstruction_method='opencv'):
     """
     Binarize raw dapi image
 
     params : - dapi (ndarray) = raw DAPI image
+             - n_jobs (int) = number of processes for the per-slice reconstruction, -1 uses all cores
+             - reconstruction_method (str) = 'opencv' for a fast morphological opening,
+                                             'scikit' for the exact grayscale reconstruction
 
-    returns : - dapi_binary (ndarray) = binarization of Dapi image
+    returns : - dapi_binary (ndarray) = boolean binarization of Dapi image
               - dapi_stacked (ndarray) =  2D stacked binarized image
     """
+    if reconstruction_method not in ('opencv', 'scikit'):
+        raise ValueError("reconstruction_method must be 'opencv' or 'scikit'")
     print('Start binarize dapi')
     degree = len(dapi.shape)
     if gauss_blur:
@@ -34,81 +119,70 @@ def binarize_dapi(dapi, fast_preprocess, gauss_blur, sigma):
             # binarize dapi
             thresh = threshold_otsu(dapi)
             binary = dapi >= thresh
-            dapi_binary = np.array(binary).astype(float)
+            dapi_binary = np.asarray(binary, dtype=bool)
             dapi_stacked = dapi_binary
         else:
-            dapi_binary = []
-            for t in tqdm(np.arange(dapi.shape[2])):
-                dapi_one_page = dapi[:, :, t]
-                thresh = threshold_otsu(dapi_one_page)
-                binary = dapi_one_page >= thresh
-                dapi_binary.append(binary)  # z,y,x
-                ### erosion on dapi binary
-            dapi_binary = np.array(dapi_binary).transpose((1, 2, 0))  # y,x,z
+            dapi_binary = otsu_stack(dapi)  # y,x,z
             dapi_stacked = np.amax(dapi_binary, axis=2)
 
     else:
         if degree == 2:
             # binarize dapi
-            dapi_marker = erosion(dapi, square(5))
-            dapi_recon = reconstruction(dapi_marker, dapi)
+            dapi_recon = _reconstruct_slice(dapi, reconstruction_method)
             thresh = threshold_otsu(dapi_recon)
             binary = dapi_recon >= thresh
-            dapi_binary = np.array(binary).astype(float)
+            dapi_binary = np.asarray(binary, dtype=bool)
             dapi_binary[dapi == 0] = False
             dapi_stacked = dapi_binary
         else:
-            dapi_binary = []
-            for t in tqdm(np.arange(dapi.shape[2])):
-                dapi_one_page = dapi[:, :, t]
-                dapi_marker = erosion(dapi_one_page, square(5))
-                dapi_recon = reconstruction(dapi_marker, dapi_one_page)
-                if len(np.unique(dapi_recon)) < 2:
-                    thresh = 0
-                    binary = dapi_recon >= thresh
-                else:
-                    thresh = threshold_otsu(dapi_recon)
-                    binary = dapi_recon >= thresh
-                dapi_binary.append(binary)  # z,y,x
-                ### erosion on dapi binary
-            dapi_binary = np.array(dapi_binary).transpose((1, 2, 0))  # y,x,z
+            reconstruct = partial(_reconstruct_slice, reconstruction_method=reconstruction_method)
+            pages = (dapi[:, :, t] for t in range(dapi.shape[2]))
+            if n_jobs == 1:
+                dapi_recon = [reconstruct(page) for page in tqdm(pages, total=dapi.shape[2])]
+            else:
+                max_workers = os.cpu_count() if n_jobs == -1 else n_jobs
+                with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                    dapi_recon = list(tqdm(executor.map(reconstruct, pages, chunksize=4),
+                                           total=dapi.shape[2]))
+            dapi_recon = np.stack(dapi_recon, axis=2)  # y,x,z
+            dapi_binary = otsu_stack(dapi_recon)  # y,x,z
             dapi_binary[dapi == 0] = False
             dapi_stacked = np.amax(dapi_binary, axis=2)
 
     return (dapi_binary, dapi_stacked)
 
 
-def preprocessing_data(spots, dapi_grid_interval, dapi_binary, LOF, contamination, xy_radius, pct_filter):
+def preprocessing_data(spots, dapi_grid_interval, dapi_binary, LOF, contamination, xy_radius, pct_filter, n_jobs=-1):
     '''
     Apply preprocessing on spots, thanks to dapi.
     We remove the 10% spots with lowest density
 
     params :    - spots (dataframe) = spatial locations and gene identity
                 - dapi_binary (ndarray) = binarized dapi image
+                - n_jobs (int) = number of parallel jobs for the radius queries, -1 uses all cores
 
     returns :   - spots (dataframe)
     '''
     print('Start preprocessing data')
-    sampling_mat = np.zeros(dapi_binary.shape)
     if len(dapi_binary.shape) == 3:
-        for ii, jj, kk in product(range(sampling_mat.shape[0]), range(sampling_mat.shape[1]),
-                                  range(sampling_mat.shape[2])):
-            if ii % dapi_grid_interval == 1 and jj % dapi_grid_interval == 1 and kk % dapi_grid_interval == 1:
-                sampling_mat[ii, jj, kk] = 1
-        dapi_sampled = dapi_binary * sampling_mat
-        dapi_coord = np.argwhere(dapi_sampled > 0)
+        # dapi pixels on the grid (1 + k * dapi_grid_interval) along every axis
+        dapi_sampled = dapi_binary[1::dapi_grid_interval, 1::dapi_grid_interval, 1::dapi_grid_interval]
+        dapi_coord = np.argwhere(dapi_sampled) * dapi_grid_interval + 1
 
         all_points = np.concatenate(
             (np.array(spots.loc[:, ['spot_location_2', 'spot_location_1', 'spot_location_3']]), dapi_coord), axis=0)
 
         # compute neighbors within radius for local density
-        knn = NearestNeighbors(radius=xy_radius * 2)
+        knn = NearestNeighbors(radius=xy_radius * 2, algorithm='kd_tree', leaf_size=40, n_jobs=n_jobs)
         knn.fit(all_points)
         spots_array = np.array(spots.loc[:, ['spot_location_2', 'spot_location_1', 'spot_location_3']])
         neigh_dist, neigh_array = knn.radius_neighbors(spots_array)
 
         # global low-density removal
-        dis_neighbors = [(ii * ii).sum(0) for ii in neigh_dist]
+        res_num_neighbors = np.fromiter(map(len, neigh_array), dtype=np.intp, count=len(neigh_array))
+        offsets = np.concatenate(([0], np.cumsum(res_num_neighbors)[:-1]))
+        flat_dist = np.concatenate(neigh_dist)
+        dis_neighbors = np.add.reduceat(flat_dist * flat_dist, offsets)
         thresh = np.percentile(dis_neighbors, pct_filter * 100)
         noisy_points = np.argwhere(dis_neighbors < thresh)[:, 0]
         spots['is_noise'] = 0
@@ -116,7 +190,6 @@ def preprocessing_data(spots, dapi_grid_interval, dapi_binary, LOF, contaminatio
 
         # LOF
         if LOF:
-            res_num_neighbors = [i.shape[0] for i in neigh_array]
             thresh = np.percentile(res_num_neighbors, 10)
             clf = LocalOutlierFactor(n_neighbors=int(thresh), contamination=contamination)
             spots_array = np.array(spots.loc[:, ['spot_location_2', 'spot_location_1', 'spot_location_3']])
@@ -124,38 +197,30 @@ def preprocessing_data(spots, dapi_grid_interval, dapi_binary, LOF, contaminatio
             spots.loc[y_pred == -1, 'is_noise'] = -1
 
         # spots in DAPI as inliers
-        inDAPI_points = [i[0] and i[1] and i[2] for i in zip(spots_array[:, 0] - 1 < dapi_binary.shape[0],
-                                                             spots_array[:, 1] - 1 < dapi_binary.shape[1],
-                                                             spots_array[:, 2] - 1 < dapi_binary.shape[2])]
-        test = dapi_binary[
-            (spots_array[:, 0] - 1)[inDAPI_points], (spots_array[:, 1] - 1)[inDAPI_points], (spots_array[:, 2] - 1)[
-                inDAPI_points]]
-        inx = 0
-        for indi, i in enumerate(inDAPI_points):
-            if i == True:
-                inDAPI_points[indi] = test[inx]
-                inx = inx + 1
+        in_bounds = ((spots_array[:, 0] - 1 < dapi_binary.shape[0])
+                     & (spots_array[:, 1] - 1 < dapi_binary.shape[1])
+                     & (spots_array[:, 2] - 1 < dapi_binary.shape[2]))
+        in_spots = spots_array[in_bounds] - 1
+        inDAPI_points = np.zeros(spots_array.shape[0], dtype=bool)
+        inDAPI_points[in_bounds] = dapi_binary[in_spots[:, 0], in_spots[:, 1], in_spots[:, 2]]
         spots.loc[inDAPI_points, 'is_noise'] = 0
     else:
-        for ii, jj in product(range(sampling_mat.shape[0]), range(sampling_mat.shape[1])):
-            if ii % dapi_grid_interval == 1 and jj % dapi_grid_interval == 1:
-                sampling_mat[ii, jj] = 1
-
-        dapi_sampled = dapi_binary * sampling_mat
-        dapi_coord = np.argwhere(dapi_sampled > 0)
+        dapi_sampled = dapi_binary[1::dapi_grid_interval, 1::dapi_grid_interval]
+        dapi_coord = np.argwhere(dapi_sampled) * dapi_grid_interval + 1
 
         all_points = np.concatenate((np.array(spots.loc[:, ['spot_location_2', 'spot_location_1']]), dapi_coord),
                                     axis=0)
 
         # compute neighbors within radius for local density
-        knn = NearestNeighbors(radius=xy_radius)
+        knn = NearestNeighbors(radius=xy_radius, algorithm='kd_tree', leaf_size=40, n_jobs=n_jobs)
         knn.fit(all_points)
         spots_array = np.array(spots.loc[:, ['spot_location_2', 'spot_location_1']])
         neigh_dist, neigh_array = knn.radius_neighbors(spots_array)
 
         # global low-density removal
-        dis_neighbors = [ii.sum(0) for ii in neigh_dist]
-        res_num_neighbors = [ii.shape[0] for ii in neigh_array]
+        res_num_neighbors = np.fromiter(map(len, neigh_array), dtype=np.intp, count=len(neigh_array))
+        offsets = np.concatenate(([0], np.cumsum(res_num_neighbors)[:-1]))
+        dis_neighbors = np.add.reduceat(np.concatenate(neigh_dist), offsets)
 
         thresh = np.percentile(dis_neighbors, pct_filter * 100)
         noisy_points = np.argwhere(dis_neighbors < thresh)[:, 0]
@@ -171,121 +236,236 @@ def preprocessing_data(spots, dapi_grid_interval, dapi_binary, LOF, contaminatio
             spots.loc[y_pred == -1, 'is_noise'] = -1
 
         # spots in DAPI as inliers
-        test = dapi_binary[list(spots_array[:, 0] - 1), list(spots_array[:, 1] - 1)]
-        spots.loc[test == True, 'is_noise'] = 0
-
-        inDAPI_points = [i[0] and i[1] for i in zip(spots_array[:, 0] - 1 < dapi_binary.shape[0],
-                                                    spots_array[:, 1] - 1 < dapi_binary.shape[1])]
-        test = dapi_binary[(spots_array[:, 0] - 1)[inDAPI_points], (spots_array[:, 1] - 1)[inDAPI_points]]
-        inx = 0
-        for indi, i in enumerate(inDAPI_points):
-            if i == True:
-                inDAPI_points[indi] = test[inx]
-                inx = inx + 1
+        in_bounds = ((spots_array[:, 0] - 1 < dapi_binary.shape[0])
+                     & (spots_array[:, 1] - 1 < dapi_binary.shape[1]))
+        in_spots = spots_array[in_bounds] - 1
+        inDAPI_points = np.zeros(spots_array.shape[0], dtype=bool)
+        inDAPI_points[in_bounds] = dapi_binary[in_spots[:, 0], in_spots[:, 1]]
         spots.loc[inDAPI_points, 'is_noise'] = 0
 
     return (spots)
 
 
-def preprocess(spots, dapi_binary, xy_radius, dapi_grid_interval=5, LOF=False, contamination=0.1, pct_filter=0.1):
+def preprocess(spots, dapi_binary, xy_radius, dapi_grid_interval=5, LOF=False, contamination=0.1, pct_filter=0.1,
+               n_jobs=-1):
     preprocessing_data(spots, dapi_grid_interval, dapi_binary, LOF, contamination, xy_radius,
-                       pct_filter)
+                       pct_filter, n_jobs=n_jobs)
     pass
 
 
 def get_distance_matrix(points):
     points_num = points.shape[0]
     print(points_num)
-    distance_matrix = np.zeros((points_num, points_num), dtype=np.float16)
-    for i in trange(points_num):
-        for j in range(points_num):
-            point_i = points[i]
-            point_j = points[j]
-            distance_matrix[i, j] = (np.sum((point_i - point_j) ** 2))
-            pass
-    return np.sqrt(distance_matrix)
+    return batch_distance(points, points).astype(np.float16, copy=False)
+
+
+@numba.njit(parallel=True)
+def _ngc_fill(neighbor_flat, offsets, genes, gene_number, row_nnz_prefix, rows_out, cols_out, data_out, row_offset):
+    # row i owns the slots row_nnz_prefix[i]:row_nnz_prefix[i + 1], unused slots keep data 0
+    spot_number = offsets.shape[0] - 1
+    chunk_number = min(numba.get_num_threads(), spot_number)
+    for chunk in numba.prange(chunk_number):
+        # one counts buffer per chunk of spots, left all zero again after every spot
+        counts = np.zeros(gene_number, dtype=np.int64)
+        for i in range(chunk * spot_number // chunk_number, (chunk + 1) * spot_number // chunk_number):
+            for k in range(offsets[i], offsets[i + 1]):
+                counts[genes[neighbor_flat[k]]] += 1
+            # walk the neighbors again to emit each gene once and reset it, O(#neighbors) instead of O(#genes)
+            pos = row_nnz_prefix[i]
+            for k in range(offsets[i], offsets[i + 1]):
+                g = genes[neighbor_flat[k]]
+                if counts[g] > 0:
+                    rows_out[pos] = row_offset + i
+                    cols_out[pos] = g
+                    # saturate instead of wrapping around when a gene has more than 127 neighbors
+                    data_out[pos] = min(counts[g], 127)
+                    counts[g] = 0
+                    pos += 1
+
+
+def _ngc_coo(res_neighbors, genes, gene_number, row_offset=0):
+    spot_number = len(res_neighbors)
+    num_neighbors = np.fromiter(map(len, res_neighbors), dtype=np.intp, count=spot_number)
+    offsets = np.zeros(spot_number + 1, dtype=np.intp)
+    np.cumsum(num_neighbors, out=offsets[1:])
+    neighbor_flat = np.concatenate(res_neighbors).astype(np.intp, copy=False)
+    # a row has at most min(#neighbors, #genes) nonzeros, preallocate the COO triples for that bound
+    row_nnz_prefix = np.zeros(spot_number + 1, dtype=np.intp)
+    np.cumsum(np.minimum(num_neighbors, gene_number), out=row_nnz_prefix[1:])
+    rows = np.empty(row_nnz_prefix[-1], dtype=np.intp)
+    cols = np.empty(row_nnz_prefix[-1], dtype=np.intp)
+    data = np.zeros(row_nnz_prefix[-1], dtype=np.int8)
+    _ngc_fill(neighbor_flat, offsets, genes, gene_number, row_nnz_prefix, rows, cols, data, row_offset)
+    used = data > 0
+    return rows[used], cols[used], data[used]
+
+
+def build_ngc_tree(spots, xy_radius, z_radius, num_dims):
+    '''
+    Build the KD-tree searched by the NGC radius queries
 
+    params :    - xy_radius, z_radius (float) = neighborhood radii, only their ratio matters
+                - num_dim (int) = 2 or 3, number of dimensions used for cell segmentation
 
-def NGC(spots, xy_radius, z_radius):
+    returns :   cKDTree over the spot locations. In 3D z is rescaled so the (xy_radius, xy_radius, z_radius)
+                ellipsoid becomes a ball of xy_radius, the same tree serves every radius with that ratio
     '''
-    Compute the NGC coordinates
+    if num_dims == 3:
+        X_data = np.array(spots[['spot_location_1', 'spot_location_2', 'spot_location_3']], dtype=np.float64)
+        X_data[:, 2] *= xy_radius / z_radius
+    else:
+        X_data = np.array(spots[['spot_location_1', 'spot_location_2']], dtype=np.float64)
+    return cKDTree(X_data, leafsize=32)
 
-    params :    - radius float) = radius for neighbors search
-                - num_dim (int) = 2 or 3, number of dimensions used for cell segmentation
+
+def NGC_with_tree(tree, spots, radius, gene_list, n_jobs=-1, tile_size=NGC_TILE_SIZE):
+    '''
+    Compute the NGC coordinates from a prebuilt tree
+
+    params :    - tree (cKDTree) = tree over the spot locations, see build_ngc_tree
+                - radius (float) = xy radius for neighbors search
                 - gene_list (1Darray) = list of genes used in the dataset
+                - n_jobs (int) = number of parallel jobs for the radius query, -1 uses all cores
+                - tile_size (int) = number of spots queried at once, bounds the memory of the neighbor lists
 
     returns :   NGC matrix. Each row is a NGC vector
     '''
     print('NGC')
-    if num_dims == 3:
-        radius = max(xy_radius, z_radius)
-        X_data = np.array(spots[['spot_location_1', 'spot_location_2', 'spot_location_3']])
-    else:
-        radius = xy_radius
-        X_data = np.array(spots[['spot_location_1', 'spot_location_2']])
-    knn = NearestNeighbors(radius=radius)
-    knn.fit(X_data)
+    X_data = tree.data
     spot_number = spots.shape[0]
-    res_dis, res_neighbors = knn.radius_neighbors(X_data, return_distance=True)
-    if num_dims == 3:
-        ### remove nearest spots outside z_radius
-        if radius == xy_radius:
-            smaller_radius = z_radius
-        else:
-            smaller_radius = xy_radius
-        for indi, i in tqdm(enumerate(res_neighbors)):
-            res_neighbors[indi] = i[X_data[i, 2] - X_data[indi, 2] <= smaller_radius]
-            res_dis[indi] = res_dis[indi][X_data[i, 2] - X_data[indi, 2] <= smaller_radius]
-
-    res_ngc = sparse.lil_matrix((spot_number, len(gene_list)), dtype=np.int8)
-    for i in trange(spot_number):
-        neighbors_i = res_neighbors[i]
-        genes_neighbors_i = spots.loc[neighbors_i, :].groupby('gene').size()
-        res_ngc[i, genes_neighbors_i.index.to_numpy() - np.min(gene_list)] = np.array(genes_neighbors_i)
-        # res_ngc[i] /= len(neighbors_i)
+    gene_number = len(gene_list)
+    genes = np.ascontiguousarray(spots['gene'].to_numpy() - np.min(gene_list), dtype=np.intp)
+    # _ngc_fill does no bounds checking, every gene code must index a column of the NGC matrix
+    if genes.size and (genes.min() < 0 or genes.max() >= gene_number):
+        raise ValueError("spots['gene'] has codes outside gene_list")
+    rows, cols, data = [], [], []
+    for start in trange(0, spot_number, tile_size):
+        res_neighbors = tree.query_ball_point(X_data[start:start + tile_size], r=radius, workers=n_jobs)
+        rows_tile, cols_tile, data_tile = _ngc_coo(res_neighbors, genes, gene_number, row_offset=start)
+        rows.append(rows_tile)
+        cols.append(cols_tile)
+        data.append(data_tile)
+        del res_neighbors
+    if not rows:
+        # no spots, no tile was queried
+        return sparse.csr_matrix((spot_number, gene_number), dtype=np.int8)
+    res_ngc = sparse.coo_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                                shape=(spot_number, gene_number), dtype=np.int8).tocsr()
     return res_ngc
 
 
+def NGC(spots, xy_radius, z_radius, gene_list, num_dims, n_jobs=-1, tile_size=NGC_TILE_SIZE):
+    '''
+    Compute the NGC coordinates
+
+    params :    - xy_radius, z_radius (float) = radii for neighbors search
+                - gene_list (1Darray) = list of genes used in the dataset
+                - num_dim (int) = 2 or 3, number of dimensions used for cell segmentation
+                - n_jobs (int) = number of parallel jobs for the radius query, -1 uses all cores
+                - tile_size (int) = number of spots queried at once, bounds the memory of the neighbor lists
+
+    returns :   NGC matrix. Each row is a NGC vector
+    '''
+    tree = build_ngc_tree(spots, xy_radius, z_radius, num_dims)
+    return NGC_with_tree(tree, spots, xy_radius, gene_list, n_jobs=n_jobs, tile_size=tile_size)
+
+
 def distance2(x, y):
-    x_y = np.array(x - y, dtype=np.float32)
-    return np.sqrt(np.sum(np.dot(x_y, x_y)))
+    # subtract in float32, int8 NGC vectors would wrap around in x - y and in the dot product
+    x_y = np.subtract(x, y, dtype=np.float32)
+    return float(np.sqrt(np.dot(x_y, x_y)))
 
 
 def spearman_corr(x, y):
     norm_x = x - np.mean(x)
     norm_y = y - np.mean(y)
-    corr = np.sum(np.array(np.dot(norm_x, norm_y), dtype=np.float32))
-    s_x = np.sum(np.array(np.dot(norm_x, norm_x), dtype=np.float32))
-    s_y = np.sum(np.array(np.dot(norm_y, norm_y), dtype=np.float32))
-    corr = corr / np.sqrt(s_x * s_y)
-    return corr
+    return float(np.dot(norm_x, norm_y) / np.sqrt(np.dot(norm_x, norm_x) * np.dot(norm_y, norm_y)))
+
+
+def batch_distance(X, Y):
+    '''
+    Pairwise euclidean distances between the rows of X and Y
+
+    returns :   (len(X), len(Y)) float32 matrix, distance2 for every pair of rows
+    '''
+    same = X is Y
+    X = np.asarray(X, dtype=np.float64)
+    Y = X if same else np.asarray(Y, dtype=np.float64)
+    # the expansion below cancels badly on raw pixel coordinates, so center on a common mean and stay in float64
+    center = (X.sum(axis=0) + Y.sum(axis=0)) / (X.shape[0] + Y.shape[0])
+    X = X - center
+    Y = X if same else Y - center
+    # ||x - y||^2 = ||x||^2 + ||y||^2 - 2 * x.y, the cross term in a single gemm
+    distance_matrix = np.einsum('ij,ij->i', X, X)[:, None] + np.einsum('ij,ij->i', Y, Y)[None, :] - 2.0 * (X @ Y.T)
+    np.clip(distance_matrix, 0, None, out=distance_matrix)
+    if same:
+        np.fill_diagonal(distance_matrix, 0)
+    return np.sqrt(distance_matrix, out=distance_matrix).astype(np.float32)
+
+
+def batch_corr(X, Y):
+    '''
+    Pairwise correlations between the rows of X and Y
+
+    returns :   (len(X), len(Y)) float32 matrix, spearman_corr for every pair of rows
+    '''
+    norm_X = np.asarray(X, dtype=np.float32)
+    norm_Y = np.asarray(Y, dtype=np.float32)
+    norm_X = norm_X - norm_X.mean(axis=1, keepdims=True)
+    norm_Y = norm_Y - norm_Y.mean(axis=1, keepdims=True)
+    s_X = np.sqrt(np.einsum('ij,ij->i', norm_X, norm_X))
+    s_Y = np.sqrt(np.einsum('ij,ij->i', norm_Y, norm_Y))
+    return (norm_X @ norm_Y.T) / np.outer(s_X, s_Y)
 
 
 # @numba.njit(parallel=True)
 def readST(dataset_file=r'stumap/dataset/STARmap_MousePlacenta'):
     with open(os.path.join(dataset_file, 'h_ngc_R.pkl'), 'rb') as f:
-        ngc_R = pickle.loads(f.read())
+        ngc_R = pickle.load(f)
         pass
     with open(os.path.join(dataset_file, 'h_ngc_3R.pkl'), 'rb') as f:
-        ngc_3R = pickle.loads(f.read())
+        ngc_3R = pickle.load(f)
         pass
     with open(os.path.join(dataset_file, 'h_ngc_5R.pkl'), 'rb') as f:
-        ngc_5R = pickle.loads(f.read())
+        ngc_5R = pickle.load(f)
         pass
     with open(os.path.join(dataset_file, 'h_p.pkl'), 'rb') as f:
-        p = pickle.loads(f.read())
-        pass
-    st_data = []
-    msngc = hstack((ngc_R, ngc_3R, ngc_5R), format='lil')
-    for i in trange(p.shape[0]):
-        st_data.append({'p': p[i], 'msngc': msngc[i, :].toarray()})
+        p = pickle.load(f)
         pass
-    with open(os.path.join(dataset_file, 'h_st.pkl'), 'wb') as f:
-        pickle.dump(st_data, f)
+    msngc = hstack((ngc_R, ngc_3R, ngc_5R), format='csr', dtype=np.int8)
+    st_file = os.path.join(dataset_file, 'h_st.pkl')
+    # one pickle per record, read them back with load_st
+    with open(st_file, 'wb') as f:
+        for record in _st_records(p, msngc):
+            pickle.dump(record, f, protocol=5)
         pass
-    return st_data
+    return st_file
+
+
+def _st_records(p, msngc):
+    indptr, indices, data = msngc.indptr, msngc.indices, msngc.data
+    for i in trange(p.shape[0]):
+        # densify the CSR row straight from its indptr slice, same (1, n) shape as msngc[i, :].toarray()
+        row = np.zeros((1, msngc.shape[1]), dtype=np.int8)
+        row[0, indices[indptr[i]:indptr[i + 1]]] = data[indptr[i]:indptr[i + 1]]
+        yield {'p': p[i], 'msngc': row}
+
+
+def load_st(st_file):
+    '''
+    Iterate over the {'p', 'msngc'} records written by readST
+    '''
+    with open(st_file, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                break
 
 def main():
+    # imported here so the module loads without the dataset loaders on the path, e.g. from the tests
+    from data_preprocess.preprocess import dataloader_STARmap_MousePlacenta, dataloader_STARmap_human_cardiac_organoid
+
     spots, dapi, gene = dataloader_STARmap_human_cardiac_organoid()
     # spots, dapi, gene, label = dataloader_STARmap_MousePlacenta()
     data = np.array(spots)
@@ -323,21 +503,24 @@ def main():
         spots_denoised = spots_denoised.drop('level_0', axis=1)
     spots_denoised.reset_index(inplace=True)
     print(f'After denoising, mRNA spots: {spots_denoised.shape[0]}')
-    ngc_R = NGC(spots_denoised, xy_radius, z_radius)
-    ngc_3R = NGC(spots_denoised, xy_radius * 3, z_radius * 3)
-    ngc_5R = NGC(spots_denoised, xy_radius * 5, z_radius * 5)
+    # R, 3R and 5R keep the xy/z ratio, so one tree serves all three scales
+    tree = build_ngc_tree(spots_denoised, xy_radius, z_radius, num_dims)
+    ngc_R = NGC_with_tree(tree, spots_denoised, xy_radius, gene_list)
+    ngc_3R = NGC_with_tree(tree, spots_denoised, xy_radius * 3, gene_list)
+    ngc_5R = NGC_with_tree(tree, spots_denoised, xy_radius * 5, gene_list)
     print(f'NGC shape is ' + str(ngc_R.shape))
     with open('h_ngc_R.pkl', 'wb') as f:
-        pickle.dump(ngc_R, f)
+        pickle.dump(ngc_R, f, protocol=5)
         pass
     with open('h_ngc_3R.pkl', 'wb') as f:
-        pickle.dump(ngc_3R, f)
+        pickle.dump(ngc_3R, f, protocol=5)
         pass
     with open('h_ngc_5R.pkl', 'wb') as f:
-        pickle.dump(ngc_5R, f)
+        pickle.dump(ngc_5R, f, protocol=5)
         pass
     with open('h_p.pkl', 'wb') as f:
-        pickle.dump(spots_denoised[['spot_location_3', 'spot_location_2', 'spot_location_1']].values, f)
+        pickle.dump(spots_denoised[['spot_location_3', 'spot_location_2', 'spot_location_1']].values, f,
+                    protocol=5)
         pass
 
 if __name__ == '__main__':
@@ -278,12 +278,19 @@ def NGC(spots, xy_radius, z_radius):
             res_neighbors[indi] = i[X_data[i, 2] - X_data[indi, 2] <= smaller_radius]
             res_dis[indi] = res_dis[indi][X_data[i, 2] - X_data[indi, 2] <= smaller_radius]
 
-    res_ngc = sparse.lil_matrix((spot_number, len(gene_list)), dtype=np.int8)
+    genes = spots['gene'].to_numpy() - np.min(gene_list)
+    rows, cols, data = [], [], []
     for i in trange(spot_number):
         neighbors_i = res_neighbors[i]
-        genes_neighbors_i = spots.loc[neighbors_i, :].groupby('gene').size()
-        res_ngc[i, genes_neighbors_i.index.to_numpy() - np.min(gene_list)] = np.array(genes_neighbors_i)
+        genes_neighbors_i = np.bincount(genes[neighbors_i], minlength=len(gene_list))
+        nonzero_i = np.nonzero(genes_neighbors_i)[0]
+        rows.append(np.full(nonzero_i.shape[0], i))
+        cols.append(nonzero_i)
+        # saturate instead of wrapping around when a gene has more than 127 neighbors
+        data.append(np.minimum(genes_neighbors_i[nonzero_i], np.iinfo(np.int8).max).astype(np.int8))
         # res_ngc[i] /= len(neighbors_i)
+    res_ngc = sparse.coo_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                                shape=(spot_number, len(gene_list)), dtype=np.int8).tocsr()
     return res_ngc
 
 
@@ -14,18 +14,15 @@ _mock_ones = np.ones(2, dtype=np.float64)
 
 
 def distance2(x, y):
-    x_y = np.array(x - y, dtype=np.float32)
-    return np.sqrt(np.sum(np.dot(x_y, x_y)))
+    # subtract in float32, int8 NGC vectors would wrap around in x - y and in the dot product
+    x_y = np.subtract(x, y, dtype=np.float32)
+    return float(np.sqrt(np.dot(x_y, x_y)))
 
 
 def spearman_corr(x, y):
     norm_x = x - np.mean(x)
     norm_y = y - np.mean(y)
-    corr = np.sum(np.array(np.dot(norm_x, norm_y), dtype=np.float32))
-    s_x = np.sum(np.array(np.dot(norm_x, norm_x), dtype=np.float32))
-    s_y = np.sum(np.array(np.dot(norm_y, norm_y), dtype=np.float32))
-    corr = corr / np.sqrt(s_x * s_y)
-    return corr
+    return float(np.dot(norm_x, norm_y) / np.sqrt(np.dot(norm_x, norm_x) * np.dot(norm_y, norm_y)))
 
 
 # Xdata = np.load('stumap/Xdata.npy')
@@ -0,0 +1,126 @@
+# ===================================================
+#  MSNGC feature extractor kernels Test cases
+# ===================================================
+
+import numpy as np
+import pytest
+from numpy.testing import assert_array_equal
+
+# Globals, used for all the tests
+SEED = 189212  # 0b101110001100011100
+
+try:
+    from stumap.MSNGC import feature_extractor
+
+    IMPORT_FEATURE_EXTRACTOR = True
+except ImportError:
+    IMPORT_FEATURE_EXTRACTOR = False
+
+try:
+    from skimage.filters import threshold_otsu
+
+    IMPORT_SKIMAGE = True
+except ImportError:
+    IMPORT_SKIMAGE = False
+
+feature_extractor_only = pytest.mark.skipif(
+    not IMPORT_FEATURE_EXTRACTOR, reason="MSNGC feature extractor dependencies not installed."
+)
+skimage_only = pytest.mark.skipif(not IMPORT_SKIMAGE, reason="scikit-image not installed.")
+
+
+@pytest.fixture(scope="module", params=[np.float64, np.uint16])
+def dapi_stack(request):
+    # bimodal float y,x,z stack: dark background with a bright square, plus one constant slice
+    rng = np.random.RandomState(SEED)
+    stack = rng.normal(100.0, 10.0, size=(40, 30, 5))
+    stack[10:25, 5:20, :] += rng.normal(400.0, 30.0, size=(15, 15, 5))
+    stack[:, :, 4] = 7.0
+    # uint16 like the raw TIFF DAPI, where skimage bins every integer value instead of using nbins
+    return stack.astype(request.param)
+
+
+@feature_extractor_only
+@skimage_only
+def test_otsu_stack_matches_skimage(dapi_stack):
+    binary = feature_extractor.otsu_stack(dapi_stack)
+    assert binary.shape == dapi_stack.shape
+    assert binary.dtype == np.bool_
+    for t in range(dapi_stack.shape[2] - 1):
+        plane = dapi_stack[:, :, t]
+        assert_array_equal(binary[:, :, t], plane >= threshold_otsu(plane))
+    # a constant slice has no threshold, every pixel is kept
+    assert binary[:, :, -1].all()
+
+
+def _random_spots(num_dims, spot_number=300, gene_number=6):
+    import pandas as pd
+
+    rng = np.random.RandomState(SEED)
+    columns = ["spot_location_1", "spot_location_2", "spot_location_3"][:num_dims]
+    spots = pd.DataFrame(rng.uniform(0.0, 60.0, size=(spot_number, num_dims)), columns=columns)
+    spots["gene"] = rng.randint(1, gene_number + 1, size=spot_number)
+    return spots, np.arange(1, gene_number + 1)
+
+
+def _brute_force_ngc(spots, xy_radius, z_radius, gene_list, num_dims):
+    columns = ["spot_location_1", "spot_location_2", "spot_location_3"][:num_dims]
+    X = np.array(spots[columns], dtype=np.float64)
+    if num_dims == 3:
+        # ellipsoid with semi-axes (xy_radius, xy_radius, z_radius)
+        X[:, 2] *= xy_radius / z_radius
+    genes = spots["gene"].to_numpy() - np.min(gene_list)
+    expected = np.zeros((X.shape[0], len(gene_list)), dtype=np.int64)
+    for i in range(X.shape[0]):
+        neighbors_i = np.nonzero(((X - X[i]) ** 2).sum(axis=1) <= xy_radius ** 2)[0]
+        expected[i] = np.bincount(genes[neighbors_i], minlength=len(gene_list))
+    return np.minimum(expected, 127)
+
+
+@feature_extractor_only
+@pytest.mark.parametrize("num_dims", [2, 3])
+def test_ngc_with_tree_matches_bincount(num_dims):
+    spots, gene_list = _random_spots(num_dims)
+    xy_radius, z_radius = 4.0, 3.0
+    # one tree serves R, 3R and 5R, as in main
+    tree = feature_extractor.build_ngc_tree(spots, xy_radius, z_radius, num_dims)
+    for scale in (1, 3, 5):
+        ngc = feature_extractor.NGC_with_tree(
+            tree, spots, xy_radius * scale, gene_list, n_jobs=1, tile_size=64
+        )
+        expected = _brute_force_ngc(spots, xy_radius * scale, z_radius * scale, gene_list, num_dims)
+        assert ngc.format == "csr"
+        assert ngc.dtype == np.int8
+        assert_array_equal(ngc.toarray(), expected)
+
+
+@feature_extractor_only
+def test_ngc_saturates_above_int8():
+    import pandas as pd
+
+    spots = pd.DataFrame(
+        {
+            "spot_location_1": np.r_[np.zeros(200), 50.0],
+            "spot_location_2": np.r_[np.zeros(200), 50.0],
+            "gene": np.r_[np.ones(200, dtype=np.int64), 2],
+        }
+    )
+    ngc = feature_extractor.NGC(spots, 1.0, 1.0, np.arange(1, 3), 2, n_jobs=1)
+    assert_array_equal(ngc[:200].toarray(), np.tile([127, 0], (200, 1)))
+    assert_array_equal(ngc[200].toarray(), [[0, 1]])
+
+
+@feature_extractor_only
+def test_ngc_without_spots():
+    spots, gene_list = _random_spots(3, spot_number=0)
+    ngc = feature_extractor.NGC(spots, 4.0, 3.0, gene_list, 3, n_jobs=1)
+    assert ngc.format == "csr"
+    assert ngc.dtype == np.int8
+    assert ngc.shape == (0, len(gene_list))
+
+
+@feature_extractor_only
+def test_ngc_rejects_genes_outside_gene_list():
+    spots, gene_list = _random_spots(2)
+    with pytest.raises(ValueError):
+        feature_extractor.NGC(spots, 4.0, 3.0, gene_list[:-1], 2, n_jobs=1)